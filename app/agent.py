@@ -4,22 +4,23 @@ import json, re, asyncio
 from typing import Any, Dict, List, Optional, Tuple
 
 from .mcp_client import MCPClientManager
+from .jsonutil import dumps
 
-CALL_RE = re.compile(r"^###\s*CALL\s*(\{.*\})\s*###\s*$", re.DOTALL)
-FINAL_RE = re.compile(r"^###\s*FINAL\s*(\{.*\})\s*###\s*$", re.DOTALL)
+# Single pattern for both reply kinds: one scan per step instead of two
+DISPATCH_RE = re.compile(r"^\s*###\s*(?P<kind>CALL|FINAL)\s*(?P<body>\{.*\})\s*###\s*$", re.DOTALL)
 
 SYSTEM_INSTRUCTION = """\
 Eres un agente que puede usar herramientas MCP para cumplir objetivos del usuario.
 Dispones de estos servidores y herramientas (formato JSON):
 
-{catalog}
+@@CATALOG@@
 
 Cómo trabajar:
 1) Piensa de manera breve qué hacer.
 2) Si NECESITAS una herramienta, responde **únicamente** una línea:
-### CALL {{"server_id":"<sid>","name":"<tool_name>","arguments":{{ ... JSON ... }}}} ###
+### CALL {"server_id":"<sid>","name":"<tool_name>","arguments":{ ... JSON ... }} ###
 3) Cuando ya tengas la respuesta final para el usuario, responde **únicamente**:
-### FINAL {{"text":"...respuesta para el usuario..."}} ###
+### FINAL {"text":"...respuesta para el usuario..."} ###
 
 Reglas IMPORTANTES:
 - Los argumentos deben ser JSON VÁLIDO y cumplir el esquema de la herramienta.
@@ -29,67 +30,139 @@ Reglas IMPORTANTES:
 - Si el usuario te pide crear un README y hacer commit, usa fs.write_file y git.* en secuencia.
 """
 
+NO_TOOLS_INSTRUCTION = """\
+Eres un asistente útil. No hay herramientas MCP disponibles en esta sesión,
+así que responde directamente al usuario en texto plano.
+"""
+
+def _parse_reply(s: str) -> Optional[Tuple[str, str]]:
+    """Devuelve (kind, body_json) de una respuesta CALL/FINAL ya stripeada, o None."""
+    # Common case: the reply starts with the marker, so slice the JSON without regex
+    for kind in ("FINAL", "CALL"):
+        if s.startswith("### " + kind) and s.endswith("###"):
+            i, j = s.find("{"), s.rfind("}")
+            if i != -1 and j > i and not s[len(kind) + 4:i].strip() and s[j + 1:-3].strip() == "":
+                return kind, s[i:j + 1]
+            break
+    m = DISPATCH_RE.match(s)
+    return (m.group("kind"), m.group("body")) if m else None
+
+def _prune(o: Any, max_str: Optional[int], max_items: Optional[int]) -> Any:
+    """Quita campos nulos/vacíos y, si se pide, recorta strings largos y listas."""
+    if isinstance(o, dict):
+        out = {}
+        for k, v in o.items():
+            v = _prune(v, max_str, max_items)
+            if v is None or v == "" or v == [] or v == {}:
+                continue
+            out[k] = v
+        return out
+    if isinstance(o, list):
+        items = [_prune(v, max_str, max_items) for v in (o[:max_items] if max_items else o)]
+        if max_items and len(o) > max_items:
+            items.append(f"…[{len(o) - max_items} elementos omitidos]")
+        return items
+    if isinstance(o, str) and max_str and len(o) > max_str:
+        return o[:max_str] + f"…[truncated {len(o) - max_str} chars]"
+    return o
+
+def _compact_obs(result: Any, max_chars: int = 2000, max_str: int = 200, max_items: int = 20) -> str:
+    """Serializa una observación para el LLM sin indentación y acotada en tamaño."""
+    text = dumps(_prune(result, None, None))
+    if len(text) > max_chars:
+        text = dumps(_prune(result, max_str, max_items))
+    if len(text) > max_chars:
+        # Many keys / nested lists can still overflow: hard cap (the JSON is cut, not parsed back)
+        text = text[:max_chars] + f"…[truncated {len(text) - max_chars} chars]"
+    return text
+
 class ToolUseAgent:
-    def __init__(self, llm_client, mcp_mgr: MCPClientManager, max_steps: int = 8):
+    def __init__(self, llm_client, mcp_mgr: MCPClientManager, max_steps: int = 8, max_format_errors: int = 2):
         self.llm = llm_client   # expects methods: start(system_prompt), ask(text)
         self.mcp = mcp_mgr
         self.max_steps = max_steps
+        self.max_format_errors = max_format_errors   # consecutive bad replies before giving up
         self._started = False
+        self._no_tools = False
+        self._system_prompt: Optional[str] = None   # cached only when built from a complete catalog
+        self._active_prompt: Optional[str] = None   # prompt the current chat was started with
+        # Rebuild the prompt (keeping the chat) after reconnects or tool-list changes
+        self.mcp.add_catalog_listener(self.invalidate)
 
     async def _build_catalog(self) -> str:
-        tools = await self.mcp.list_tools()
-        # Render a compact JSON with schemas
-        display = {}
-        for sid, arr in tools.items():
-            display[sid] = [
-                {
-                    "name": t.get("name"),
-                    "description": t.get("description"),
-                    "input_schema": t.get("input_schema"),
-                } for t in arr
-            ]
-        return json.dumps(display, ensure_ascii=False, indent=2)
+        catalog = await self.mcp.render_catalog()
+        # Without tools the CALL/FINAL protocol is pure overhead
+        self._no_tools = self.mcp.catalog_empty
+        return catalog
 
     async def start(self):
-        if self._started: 
+        if self._system_prompt is not None:
             return
         catalog = await self._build_catalog()
-        system = SYSTEM_INSTRUCTION.format(catalog=catalog)
-        self.llm.start(system_instruction=system)
+        system = NO_TOOLS_INSTRUCTION if self._no_tools else SYSTEM_INSTRUCTION.replace("@@CATALOG@@", catalog)
+        if system != self._active_prompt:
+            # A rebuild (reconnect, tool changes) must not wipe the ongoing conversation
+            self.llm.start(system_instruction=system, keep_history=self._started)
+            self._active_prompt = system
         self._started = True
+        # Partial/empty listings are not kept: the next run() asks the servers again
+        if self.mcp.catalog_complete:
+            self._system_prompt = system
+
+    async def invalidate(self):
+        """Marca el system prompt como obsoleto; el próximo run() lo reconstruye."""
+        self._system_prompt = None
 
     async def run(self, user_text: str) -> Dict[str, Any]:
         """Runs an agentic loop until FINAL. Returns {'final': str, 'trace': [...]}"""
         await self.start()
         trace: List[Dict[str, Any]] = []
-        # Send the user query
+        if self._no_tools:
+            # Single round-trip: nothing to call, answer directly
+            reply = self.llm.ask(f"Usuario: {user_text}\nResponde directo.")
+            parsed = _parse_reply(reply.strip())
+            if parsed and parsed[0] == "FINAL":
+                try:
+                    reply = json.loads(parsed[1]).get("text", reply)
+                except json.JSONDecodeError:
+                    pass
+            return {"final": reply, "trace": trace}
+        # Send the user query; a FINAL on this first reply returns without re-asking
         msg = f"Usuario: {user_text}\nRecuerda usar CALL/FINAL."
         reply = self.llm.ask(msg)
+        bad = 0
         for step in range(self.max_steps):
-            # Check for FINAL
-            m_final = FINAL_RE.match(reply.strip())
-            if m_final:
+            s = reply.strip()
+            parsed = _parse_reply(s)
+            if not parsed:
+                bad += 1
+                if bad >= self.max_format_errors:
+                    return {"final": "El modelo no siguió el formato CALL/FINAL.", "trace": trace}
+                # Ask model to follow the format
+                reply = self.llm.ask("El formato no es válido. Debes responder con ### CALL {...} ### o ### FINAL {...} ### únicamente. Reintenta.")
+                continue
+
+            kind, body = parsed
+            if kind == "FINAL":
                 try:
-                    payload = json.loads(m_final.group(1))
+                    payload = json.loads(body)
                 except json.JSONDecodeError:
                     payload = {"text": reply}
                 return {"final": payload.get("text", reply), "trace": trace}
 
-            # Otherwise expect CALL
-            m_call = CALL_RE.match(reply.strip())
-            if not m_call:
-                # Ask model to follow the format
-                reply = self.llm.ask("El formato no es válido. Debes responder con ### CALL {...} ### o ### FINAL {...} ### únicamente. Reintenta.")
-                continue
-
+            # Otherwise it is a CALL
             try:
-                call_payload = json.loads(m_call.group(1))
+                call_payload = json.loads(body)
                 sid = call_payload["server_id"]
                 name = call_payload["name"]
                 args = call_payload.get("arguments", {}) or {}
             except Exception as e:
+                bad += 1
+                if bad >= self.max_format_errors:
+                    return {"final": "El modelo no siguió el formato CALL/FINAL.", "trace": trace}
                 reply = self.llm.ask(f"El JSON del CALL no es válido ({e}). Reintentemos con el formato indicado.")
                 continue
+            bad = 0
 
             # Execute the tool via MCP
             try:
@@ -97,7 +170,7 @@ class ToolUseAgent:
                 obs = {"server_id": sid, "name": name, "args": args, "result": result}
                 trace.append({"type":"call", **obs})
                 # Feed observation
-                reply = self.llm.ask(f"OBSERVACIÓN:\n{json.dumps(result, ensure_ascii=False)}\nAhora continúa. Recuerda usar CALL/FINAL.")
+                reply = self.llm.ask(f"OBSERVACIÓN:\n{_compact_obs(result)}\nAhora continúa. Recuerda usar CALL/FINAL.")
             except Exception as e:
                 trace.append({"type":"error", "server_id": sid, "name": name, "args": args, "error": str(e)})
                 reply = self.llm.ask(f"ERROR al ejecutar la herramienta {sid}:{name} — {e}. Corrige los parámetros o elige otra herramienta y reintenta con CALL.")
@@ -0,0 +1,21 @@
+from __future__ import annotations
+import json
+from typing import Any
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # orjson es opcional; se usa json de la stdlib
+    orjson = None
+
+def dumps(obj: Any, indent: bool = False) -> str:
+    """json.dumps(ensure_ascii=False) acelerado con orjson cuando está instalado."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option, default=str).decode()
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None, default=str)
+
+def dumpb(obj: Any) -> bytes:
+    """Igual que dumps() pero en bytes UTF-8, sin decodificar cuando hay orjson."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS, default=str)
+    return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
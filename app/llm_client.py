@@ -1,5 +1,6 @@
 from __future__ import annotations
-import google.generativeai as genai
+import hashlib
+from typing import Any, Dict
 from .config import GOOGLE_API_KEY, GEMINI_MODEL
 
 class LLMClient:
@@ -7,8 +8,12 @@ class LLMClient:
     def __init__(self):
         if not GOOGLE_API_KEY:
             raise RuntimeError("Falta GOOGLE_API_KEY en el entorno (.env).")
+        # Heavy import (protobuf/grpc); deferred until a client is built (main.py does so on the first chat)
+        import google.generativeai as genai
         genai.configure(api_key=GOOGLE_API_KEY)
         self.model = genai.GenerativeModel(GEMINI_MODEL)
+        # Models keyed by system_instruction digest, reused across restarts
+        self._models: Dict[str, Any] = {}
         self.chat = self.model.start_chat(history=[])
 
     def ask(self, user_text: str) -> str:
@@ -29,12 +34,19 @@ class LLMClient:
         return text or ""
 
 
-    def start(self, system_instruction: str | None = None):
-        """(Re)inicia el chat opcionalmente con un system_instruction."""
+    def start(self, system_instruction: str | None = None, keep_history: bool = False):
+        """(Re)inicia el chat opcionalmente con un system_instruction.
+
+        Con keep_history=True solo cambia el system_instruction y se conserva la conversación.
+        """
         import google.generativeai as genai
         if system_instruction:
-            self.model = genai.GenerativeModel(self.model.model_name if hasattr(self.model, "model_name") else "gemini-1.5-flash",
-                                               system_instruction=system_instruction)
-        self.chat = self.model.start_chat(history=[])
+            key = hashlib.blake2b(system_instruction.encode("utf-8"), digest_size=16).hexdigest()
+            model = self._models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(GEMINI_MODEL, system_instruction=system_instruction)
+                self._models[key] = model
+            self.model = model
+        history = list(self.chat.history) if keep_history and self.chat is not None else []
+        self.chat = self.model.start_chat(history=history)
         return self
-
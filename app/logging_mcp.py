@@ -1,16 +1,85 @@
 from __future__ import annotations
-import json, time
+import io, json, os, queue, threading, time
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List
+
+from .jsonutil import dumpb
+
+_STOP = object()
 
 class JsonlLogger:
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, max_queue: int = 10000, max_batch: int = 256):
         self.path = Path(path)
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        self.path.open("a", encoding="utf-8").close()
+        # Single append handle for the whole session instead of open/close per event;
+        # O_APPEND keeps each batch write atomic w.r.t. other appenders to the same file
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._fh = io.BufferedWriter(io.FileIO(fd, "ab"), buffer_size=64 * 1024)
+        self.max_batch = max_batch
+        self.dropped = 0
+        # File I/O happens on a daemon thread so write() never blocks the event loop
+        self._q: "queue.Queue[Any]" = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._drain, name="jsonl-logger", daemon=True)
+        self._thread.start()
 
     def write(self, record: Dict[str, Any]) -> None:
         rec = dict(record)
         rec.setdefault("ts", time.time())
-        with self.path.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        try:
+            self._q.put_nowait(rec)
+        except queue.Full:
+            self.dropped += 1
+
+    def _encode(self, rec: Any) -> bytes:
+        # One bad record must not take the writer thread (or its batch) down with it
+        try:
+            return dumpb(rec) + b"\n"
+        except Exception as e:
+            try:
+                return json.dumps(rec, ensure_ascii=False, default=str).encode("utf-8") + b"\n"
+            except Exception:
+                stub = {"event": "encode_error", "error": str(e), "ts": time.time()}
+                return json.dumps(stub, ensure_ascii=False).encode("utf-8") + b"\n"
+
+    def _write_batch(self, batch: List[Any]) -> None:
+        # Per-record encoding: a bad record costs only itself, not the rest of the batch
+        self._fh.write(b"".join(self._encode(r) for r in batch))
+        self._fh.flush()
+
+    def _drain(self) -> None:
+        stop = False
+        while not stop:
+            batch = [self._q.get()]
+            # Take whatever else is already queued so a burst costs one write + flush
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stop = True
+                batch = [r for r in batch if r is not _STOP]
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception:
+                    pass  # disk errors: drop this batch, keep the thread alive
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._q.put(_STOP)
+            self._thread.join()
+        else:
+            # Writer is gone: flush whatever is still queued from this thread
+            rest = []
+            while True:
+                try:
+                    rec = self._q.get_nowait()
+                except queue.Empty:
+                    break
+                if rec is not _STOP:
+                    rest.append(rec)
+            if rest and not self._fh.closed:
+                self._write_batch(rest)
+        if not self._fh.closed:
+            self._fh.close()
@@ -1,10 +1,10 @@
 from __future__ import annotations
 import asyncio, json
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from rich.console import Console
 from rich.prompt import Prompt
 
-from .config import SERVERS_YAML, SERVERS_EXAMPLE, WORKSPACE_DIR, LOG_PATH
+from .config import SERVERS_YAML, SERVERS_EXAMPLE, WORKSPACE_DIR, LOG_PATH, GOOGLE_API_KEY
 from .llm_client import LLMClient
 from .mcp_client import MCPClientManager, ServerConfig
 from .agent import ToolUseAgent
@@ -28,37 +28,26 @@ def load_servers() -> List[ServerConfig]:
 async def run_cli():
     console.print(f"[bold green]MCP Host CLI (Gemini)[/] — logs: {LOG_PATH}")
     console.print(f"Workspace: {WORKSPACE_DIR}")
-    try:
-        llm = LLMClient()
-    except Exception as e:
-        console.print(f"[yellow]Advertencia:[/] LLM no inicializado — {e}")
-        llm = None
+    if not GOOGLE_API_KEY:
+        console.print("[yellow]Advertencia:[/] falta GOOGLE_API_KEY; el chat con el LLM no estará disponible")
+    # Built on the first chat message so :tools/:call/:scenario never pay the Gemini SDK import
+    llm: Optional[LLMClient] = None
+    llm_error: Optional[str] = None
 
     servers = load_servers()
     mcp_mgr = MCPClientManager(servers)
     await mcp_mgr.start()
-    agent = ToolUseAgent(llm, mcp_mgr, max_steps=25)
-    console.print(f"[cyan]MCP conectado.[/] Usa :tools para listar herramientas.")
-
-    console.print("\nEscribe texto para chatear con el LLM (con uso de herramientas). Comandos disponibles:")
-    console.print(":help — ayuda")
-    console.print(":tools — listar herramientas conectadas")
-    console.print(":call <server> <tool> {json} — invocar manualmente")
-    console.print(":scenario — demo inciso 4 (fs + git)")
-    while True:
-        try:
-            cmd = Prompt.ask("[bold magenta](mcp) ›[/]")
-        except (EOFError, KeyboardInterrupt):
-            console.print("\nSaliendo...")
-            break
-
-        if not cmd.strip():
-            continue
-
-        if cmd.strip() in (":q", ":quit", ":exit"):
-            break
-
-        if cmd.strip() in (":help", ":h"):
+    try:
+        agent = ToolUseAgent(llm, mcp_mgr, max_steps=25)
+        console.print(f"[cyan]MCP conectado.[/] Usa :tools para listar herramientas.")
+
+        console.print("\nEscribe texto para chatear con el LLM (con uso de herramientas). Comandos disponibles:")
+        console.print(":help — ayuda")
+        console.print(":tools — listar herramientas conectadas")
+        console.print(":call <server> <tool> {json} — invocar manualmente")
+        console.print(":scenario — demo inciso 4 (fs + git)")
+
+        async def cmd_help(rest: str) -> None:
             console.print("""
 [bold]:help[/] — esta ayuda
 [bold]:servers[/] — lista servidores conectados
@@ -69,72 +58,74 @@ async def run_cli():
 [bold]:log[/] — muestra ruta del log
 [bold]:q[/] — salir
             """.strip())
-            continue
 
-        if cmd.strip() == ":log":
+        async def cmd_log(rest: str) -> None:
             console.print(f"Log JSONL: {LOG_PATH}")
-            continue
 
-        if cmd.strip() == ":servers":
+        async def cmd_servers(rest: str) -> None:
             sids = list(mcp_mgr._sessions.keys())
             console.print(f"Servers: {', '.join(sids) if sids else '(ninguno)'}")
-            continue
 
-        if cmd.startswith(":tools"):
-            parts = cmd.split()
-            server = parts[1] if len(parts) > 1 else None
+        async def cmd_tools(rest: str) -> None:
+            server = rest.split()[0] if rest.split() else None
             tools = await mcp_mgr.list_tools(server)
+            lines: List[str] = []
             for sid, arr in tools.items():
-                console.print(f"[bold]{sid}[/] — {len(arr)} tools")
-                for t in arr:
-                    console.print(f"  - {t.get('name')}: {t.get('description','')}")
-            continue
+                lines.append(f"[bold]{sid}[/] — {len(arr)} tools")
+                lines.extend(f"  - {t.get('name')}: {t.get('description','')}" for t in arr)
+            if lines:
+                console.print("\n".join(lines))
 
-        if cmd.startswith(":schema "):
+        async def cmd_schema(rest: str) -> None:
             try:
-                _, sid, tool = cmd.split(maxsplit=2)
+                sid, tool = rest.split(maxsplit=1)
             except ValueError:
                 console.print("[red]Uso:[/] :schema <server> <tool>")
-                continue
+                return
             try:
                 info = await mcp_mgr.get_schema(sid, tool)
                 console.print(f"[bold]{sid}:{tool}[/] — {info.get('description','')}")
                 console.print_json(data=info.get("input_schema"))
             except Exception as e:
                 console.print(f"[red]No se pudo obtener esquema:[/] {e}")
-            continue
 
-        if cmd.startswith(":call "):
+        async def cmd_call(rest: str) -> None:
             try:
-                _, sid, tool, *rest = cmd.split(maxsplit=3)
+                sid, tool, *extra = rest.split(maxsplit=2)
             except ValueError:
                 console.print("[red]Uso:[/] :call <server> <tool> <json-args>")
-                continue
+                return
             args: Dict[str, Any] = {}
-            if rest:
+            if extra:
                 try:
-                    args = json.loads(rest[0])
+                    args = json.loads(extra[0])
                 except json.JSONDecodeError as e:
                     console.print(f"[red]JSON inválido:[/] {e}")
-                    continue
+                    return
             try:
                 res = await mcp_mgr.call_tool(sid, tool, args)
                 console.print_json(data=res)
             except Exception as e:
                 console.print(f"[red]Error en tools/call:[/] {e}")
-            continue
 
-        if cmd.strip() == ":scenario":
+        async def cmd_scenario(rest: str) -> None:
             steps = await mcp_mgr.run_inciso4_scenario()
             console.print("[bold green]Escenario inciso 4 completado (parcial si faltó Git). Pasos:[/]")
             for s in steps:
                 console.print(f"  - {s}")
-            continue
 
-        if llm is None:
-            console.print("[red]LLM no configurado; configura GOOGLE_API_KEY en .env[/]")
-        else:
-            out = await agent.run(cmd)
+        async def chat(text: str) -> None:
+            nonlocal llm, llm_error
+            if llm is None and llm_error is None:
+                try:
+                    llm = LLMClient()
+                    agent.llm = llm
+                except Exception as e:
+                    llm_error = str(e)
+            if llm is None:
+                console.print(f"[red]LLM no configurado ({llm_error}); configura GOOGLE_API_KEY en .env[/]")
+                return
+            out = await agent.run(text)
             console.print(f"[bold blue]Respuesta:[/] {out.get('final')}")
             if out.get("trace"):
                 console.print("[dim]Herramientas utilizadas:[/]")
@@ -143,7 +134,40 @@ async def run_cli():
                         console.print(f"  - {t['server_id']}::{t['name']} → ok")
                     elif t.get("type") == "error":
                         console.print(f"  - {t['server_id']}::{t['name']} → ERROR: {t.get('error')}")
-    await mcp_mgr.close()
+
+        # First token -> handler; anything that is not a command goes to the LLM
+        handlers = {
+            ":help": cmd_help, ":h": cmd_help,
+            ":log": cmd_log,
+            ":servers": cmd_servers,
+            ":tools": cmd_tools,
+            ":schema": cmd_schema,
+            ":call": cmd_call,
+            ":scenario": cmd_scenario,
+        }
+        quit_cmds = (":q", ":quit", ":exit")
+
+        while True:
+            try:
+                cmd = Prompt.ask("[bold magenta](mcp) ›[/]")
+            except (EOFError, KeyboardInterrupt):
+                console.print("\nSaliendo...")
+                break
+
+            line = cmd.strip()
+            if not line:
+                continue
+            key, _, rest = line.partition(" ")
+            if key in quit_cmds:
+                break
+            handler = handlers.get(key)
+            if handler is not None:
+                await handler(rest.strip())
+            else:
+                await chat(line)
+    finally:
+        # Also on errors from agent.run/llm.ask: flushes queued log records
+        await mcp_mgr.close()
 
 def main():
     try:
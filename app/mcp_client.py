@@ -1,14 +1,114 @@
 from __future__ import annotations
-import os, json, shutil, subprocess
+import os, asyncio, hashlib, time
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
-from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from contextlib import AsyncExitStack
 
 from .logging_mcp import JsonlLogger
+from .jsonutil import dumps
 from .config import LOG_PATH, WORKSPACE_DIR
 
-@dataclass
+try:
+    from mcp import ClientSession as _ClientSession, StdioServerParameters as _StdioServerParameters  # type: ignore
+    from mcp.client.stdio import stdio_client as _stdio_client  # type: ignore
+    import anyio  # type: ignore  # dependency of the SDK transports
+    _TRANSPORT_ERRORS: Tuple[type, ...] = (ConnectionError, anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream)
+    _SDK_AVAILABLE = True
+    _SDK_IMPORT_ERROR: Optional[BaseException] = None
+except Exception as e:
+    _TRANSPORT_ERRORS = (ConnectionError,)
+    _SDK_AVAILABLE = False
+    _SDK_IMPORT_ERROR = e  # re-raised as the cause in start()
+
+_CONNECTION_CLOSED = -32000  # JSON-RPC code McpError uses when the stdio pipe closes
+
+def _is_transport_error(e: BaseException) -> bool:
+    return isinstance(e, _TRANSPORT_ERRORS) or getattr(getattr(e, "error", None), "code", None) == _CONNECTION_CLOSED
+
+try:
+    import fastjsonschema  # type: ignore
+except ImportError:  # opcional: sin él no se validan argumentos en el cliente
+    fastjsonschema = None
+
+def _to_plain(o: Any) -> Any:
+    """Convierte objetos del SDK a tipos JSON planos en una sola pasada."""
+    if isinstance(o, (str, int, float, bool, type(None))):
+        return o
+    if isinstance(o, dict):
+        return {k: _to_plain(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [_to_plain(v) for v in o]
+    dump = getattr(o, "model_dump", None)
+    if callable(dump):
+        # pydantic v2 (MCP SDK types): native conversion, no JSON text produced
+        return dump(mode="json")
+    d = getattr(o, "__dict__", None)
+    return {k: _to_plain(v) for k, v in d.items()} if d else str(o)
+
+_SCHEMA_ATTRS: Dict[type, Optional[str]] = {}
+
+def _schema_attr(t: Any) -> Optional[str]:
+    # Which attribute holds the schema is a property of the SDK class: resolve it once per type
+    cls = type(t)
+    if cls not in _SCHEMA_ATTRS:
+        fields = getattr(cls, "model_fields", None) or getattr(t, "__dict__", None) or {}
+        _SCHEMA_ATTRS[cls] = next((a for a in ("inputSchema", "input_schema") if a in fields), None)
+    return _SCHEMA_ATTRS[cls]
+
+def _normalize_tool(t: Any) -> Dict[str, Any]:
+    """Tool del SDK -> {name, description, input_schema} con tipos planos."""
+    attr = _schema_attr(t)
+    schema = getattr(t, attr, None) if attr else None
+    return {"name": getattr(t, "name", None), "description": getattr(t, "description", None), "input_schema": _to_plain(schema)}
+
+_LOG_MAX_STR = 256 * 1024  # longer strings are logged as a digest, not verbatim
+
+def _log_view(o: Any) -> Any:
+    """Copia para el log con los strings enormes reemplazados por {sha256, size}."""
+    if isinstance(o, str) and len(o) > _LOG_MAX_STR:
+        data = o.encode("utf-8")
+        return {"sha256": hashlib.sha256(data).hexdigest(), "size": len(data)}
+    if isinstance(o, dict):
+        return {k: _log_view(v) for k, v in o.items()}
+    if isinstance(o, list):
+        return [_log_view(v) for v in o]
+    return o
+
+def _compact_prop(p: Any, max_desc: int, depth: int = 1) -> Dict[str, Any]:
+    """Resumen de una propiedad: type (anyOf colapsado a lista de tipos), enum, items y description."""
+    p = p if isinstance(p, dict) else {}
+    entry: Dict[str, Any] = {}
+    if "type" in p:
+        entry["type"] = p["type"]
+    elif isinstance(p.get("anyOf"), list):
+        # pydantic Optional[int] -> anyOf [{type: integer}, {type: null}] -> ["integer", "null"]
+        types = [t.get("type") for t in p["anyOf"] if isinstance(t, dict) and t.get("type")]
+        if types:
+            entry["type"] = types
+    if "enum" in p:
+        entry["enum"] = p["enum"]
+    if isinstance(p.get("items"), dict) and depth > 0:
+        items = p["items"]
+        entry["items"] = _compact_schema(items, max_desc, depth - 1) if "properties" in items else _compact_prop(items, max_desc, depth - 1)
+    if p.get("description"):
+        entry["description"] = str(p["description"])[:max_desc]
+    return entry
+
+def _compact_schema(schema: Any, max_desc: int = 120, depth: int = 1) -> Any:
+    """Resumen de un JSON Schema para el prompt: type, required y propiedades compactadas."""
+    if not isinstance(schema, dict):
+        return schema
+    out: Dict[str, Any] = {}
+    if "type" in schema:
+        out["type"] = schema["type"]
+    if schema.get("required"):
+        out["required"] = schema["required"]
+    props = schema.get("properties")
+    if isinstance(props, dict):
+        out["properties"] = {name: _compact_prop(p, max_desc, depth) for name, p in props.items()}
+    return out
+
+@dataclass(slots=True)
 class ServerConfig:
     id: str
     command: str
@@ -16,37 +116,138 @@ class ServerConfig:
     env: Dict[str,str]
 
 class MCPClientManager:
+    TOOLS_TTL = 300.0  # seconds a tools/list result is reused; tool sets rarely change mid-session
+    READY_TIMEOUT = 30.0  # seconds call_tool waits for a server that is still coming up
+    RECONNECT_ATTEMPTS = 3
+    RECONNECT_BACKOFF = 0.5  # seconds, doubled after each failed attempt
+
     def __init__(self, servers: List[ServerConfig]):
         self.servers_cfg = servers
         self.logger = JsonlLogger(LOG_PATH)
         self._sessions: Dict[str, Any] = {}
-        self._sdk = None
-        self._exit_stack: Optional[AsyncExitStack] = None
-        self._sessions: Dict[str, Any] = {}
-        self._sdk = None
         self._exit_stack: Optional[AsyncExitStack] = None
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+        self._ready: Dict[str, asyncio.Event] = {s.id: asyncio.Event() for s in servers}
+        # Per-server lifecycle: a stop signal for its task and a lock so reconnects don't overlap
+        self._stops: Dict[str, asyncio.Event] = {}
+        self._reconnect_locks: Dict[str, asyncio.Lock] = {s.id: asyncio.Lock() for s in servers}
+        self._cfg_by_id: Dict[str, ServerConfig] = {s.id: s for s in servers}
+        self._envs: Dict[str, Optional[Dict[str, str]]] = {}
+        self._dropped: Set[str] = set()  # servers whose session died after a successful start
+        self._catalog_cache: Optional[str] = None
+        self._catalog_key: Optional[frozenset] = None
+        self.catalog_empty = True
+        self.catalog_complete = False  # last render_catalog() covered every session
+        self._catalog_listeners: List[Callable[[], Awaitable[None]]] = []
+        # server_id -> (monotonic ts, normalized tools)
+        self._tools_cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        # (server_id, tool_name) -> normalized tool, filled alongside _tools_cache
+        self._schema_index: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._validators: Dict[Tuple[str, str], Optional[Callable[[Any], Any]]] = {}
 
     async def start(self) -> None:
-        try:
-            from mcp import ClientSession, StdioServerParameters  # type: ignore
-            from mcp.client.stdio import stdio_client  # type: ignore
-            self._sdk = {"ClientSession": ClientSession, "StdioServerParameters": StdioServerParameters, "stdio_client": stdio_client}
-        except Exception as e:
-            raise RuntimeError("El SDK de MCP no está disponible. Instala la librería `mcp` y sus dependencias.") from e
+        if not _SDK_AVAILABLE:
+            raise RuntimeError("El SDK de MCP no está disponible. Instala la librería `mcp` y sus dependencias.") from _SDK_IMPORT_ERROR
 
         self._exit_stack = AsyncExitStack()
         await self._exit_stack.__aenter__()
+        self._exit_stack.push_async_callback(self._stop_servers)
 
-        for s in self.servers_cfg:
-            try:
-                params = self._sdk["StdioServerParameters"](command=s.command, args=s.args, env={**os.environ, **s.env} if s.env else None)
-                stdio, write = await self._exit_stack.enter_async_context(self._sdk["stdio_client"](params))
-                session = await self._exit_stack.enter_async_context(self._sdk["ClientSession"](stdio, write))
+        # Bring every server up concurrently: cold start costs max() instead of sum()
+        # One os.environ snapshot, merged once per server (reused on reconnect)
+        base = dict(os.environ)
+        self._envs = {s.id: (base | s.env) if s.env else None for s in self.servers_cfg}
+        await asyncio.gather(*(self._launch(s) for s in self.servers_cfg))
+
+    def _launch(self, s: ServerConfig) -> "asyncio.Future[bool]":
+        ready = asyncio.get_running_loop().create_future()
+        self._stops[s.id] = asyncio.Event()
+        self._tasks[s.id] = asyncio.create_task(self._serve(s, ready, self._stops[s.id]), name=f"mcp-{s.id}")
+        return ready
+
+    async def _serve(self, s: ServerConfig, ready: "asyncio.Future[bool]", stop: asyncio.Event) -> None:
+        # Each server owns a child AsyncExitStack entered and exited in this same task,
+        # which the SDK's anyio task groups require; the parent stack only stops the tasks.
+        error: Optional[BaseException] = None
+        try:
+            async with AsyncExitStack() as child:
+                params = _StdioServerParameters(command=s.command, args=s.args, env=self._envs.get(s.id))
+                stdio, write = await child.enter_async_context(_stdio_client(params))
+                try:
+                    client = _ClientSession(stdio, write, message_handler=self._message_handler(s.id))
+                except TypeError:
+                    # Older SDKs have no message_handler; rely on the TTL alone
+                    client = _ClientSession(stdio, write)
+                session = await child.enter_async_context(client)
                 await session.initialize()
+                self.invalidate_tools(s.id)
                 self._sessions[s.id] = session
+                self._ready[s.id].set()
                 self.logger.write({"event":"initialize","server":s.id})
-            except Exception as e:
+                ready.set_result(True)
+                await stop.wait()
+        except Exception as e:
+            error = e
+            if not ready.done():
                 self.logger.write({"event":"initialize_error","server":s.id,"error":str(e)})
+        finally:
+            self._sessions.pop(s.id, None)
+            self._ready[s.id].clear()
+            if not ready.done():
+                ready.set_result(False)
+            elif ready.result() and not stop.is_set():
+                # Was up and died on its own (transport failure): record it so the next call reconnects
+                self._dropped.add(s.id)
+                self.logger.write({"event":"disconnect","server":s.id,"error":str(error) if error else None})
+
+    async def _stop_one(self, server_id: str) -> None:
+        stop, task = self._stops.get(server_id), self._tasks.pop(server_id, None)
+        if stop is not None:
+            stop.set()
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _stop_servers(self) -> None:
+        for stop in self._stops.values():
+            stop.set()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    async def _reconnect(self, server_id: str, broken: Any) -> bool:
+        """Reinicia solo el servidor caído (con backoff); los demás siguen intactos."""
+        async with self._reconnect_locks[server_id]:
+            current = self._sessions.get(server_id)
+            if current is not None and current is not broken:
+                return True  # another caller already brought it back
+            await self._stop_one(server_id)
+            self._dropped.discard(server_id)
+            cfg = self._cfg_by_id[server_id]
+            delay = self.RECONNECT_BACKOFF
+            for attempt in range(1, self.RECONNECT_ATTEMPTS + 1):
+                if await self._launch(cfg):
+                    self.logger.write({"event":"reconnect","server":server_id,"attempt":attempt})
+                    await self.notify_reconnect()
+                    return True
+                self.logger.write({"event":"reconnect_error","server":server_id,"attempt":attempt})
+                if attempt < self.RECONNECT_ATTEMPTS:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+            return False
+
+    def add_catalog_listener(self, cb: Callable[[], Awaitable[None]]) -> None:
+        """Registra un callback para cuando el catálogo de tools deja de ser válido."""
+        self._catalog_listeners.append(cb)
+
+    async def notify_catalog_changed(self) -> None:
+        # Listeners only mark state stale (e.g. the agent prompt); nothing is restarted here
+        for cb in self._catalog_listeners:
+            await cb()
+
+    async def notify_reconnect(self) -> None:
+        """Invalida caches dependientes de las sesiones y avisa a los listeners."""
+        self._catalog_cache = None
+        self._catalog_key = None
+        await self.notify_catalog_changed()
 
     async def close(self) -> None:
         if self._exit_stack is not None:
@@ -54,62 +255,189 @@ class MCPClientManager:
                 await self._exit_stack.aclose()
             except Exception:
                 pass
+        self.logger.close()
 
     async def list_tools(self, server_id: Optional[str]=None) -> Dict[str, List[Dict[str, Any]]]:
         out: Dict[str, List[Dict[str, Any]]] = {}
-        if True:
-            targets = [(server_id, self._sessions.get(server_id))] if server_id else self._sessions.items()
-            for sid, session in targets:
-                if not session:
-                    continue
-                try:
-                    response = await session.list_tools()
-                    tools = getattr(response, "tools", []) or []
-                    arr = []
-                    for t in tools:
-                        name = getattr(t, "name", None)
-                        desc = getattr(t, "description", None)
-                        schema = getattr(t, "input_schema", None) or getattr(t, "inputSchema", None)
-                        try:
-                            schema = json.loads(json.dumps(schema, default=lambda o: getattr(o, "__dict__", str(o))))
-                        except Exception:
-                            pass
-                        arr.append({"name": name, "description": desc, "input_schema": schema})
-                    out[sid] = arr
-                    self.logger.write({"event":"tools/list","server":sid,"tools_count":len(arr)})
-                except Exception as e:
-                    self.logger.write({"event":"tools/list_error","server":sid,"error":str(e)})
+        targets = [(server_id, self._sessions.get(server_id))] if server_id else self._sessions.items()
+        now = time.monotonic()
+        pending = []
+        for sid, session in targets:
+            if not session:
+                continue
+            cached = self._tools_cache.get(sid)
+            if cached and now - cached[0] < self.TOOLS_TTL:
+                out[sid] = cached[1]
+            else:
+                pending.append((sid, session))
+        # Independent RPCs per server: fan out so latency is max() instead of sum()
+        responses = await asyncio.gather(*(session.list_tools() for _, session in pending), return_exceptions=True)
+        for (sid, _), response in zip(pending, responses):
+            if isinstance(response, BaseException):
+                self.invalidate_tools(sid)
+                self.logger.write({"event":"tools/list_error","server":sid,"error":str(response)})
+                continue
+            try:
+                arr = [_normalize_tool(t) for t in getattr(response, "tools", []) or []]
+                out[sid] = arr
+                self._tools_cache[sid] = (now, arr)
+                # Fresh listing: drop the previous one's entries (removed tools, stale validators)
+                self._drop_index(sid)
+                for t in arr:
+                    self._schema_index[(sid, t["name"])] = t
+                self.logger.write({"event":"tools/list","server":sid,"tools_count":len(arr)})
+            except Exception as e:
+                self.invalidate_tools(sid)
+                self.logger.write({"event":"tools/list_error","server":sid,"error":str(e)})
         return out
 
+    def invalidate_tools(self, server_id: str) -> None:
+        """Olvida el listado cacheado de un servidor (y el catálogo que depende de él)."""
+        self._tools_cache.pop(server_id, None)
+        self._drop_index(server_id)
+        self._catalog_cache = None
+        self._catalog_key = None
+
+    def _drop_index(self, server_id: str) -> None:
+        for key in [k for k in self._schema_index if k[0] == server_id]:
+            del self._schema_index[key]
+        for key in [k for k in self._validators if k[0] == server_id]:
+            del self._validators[key]
+
+    def _message_handler(self, server_id: str) -> Callable[[Any], Awaitable[None]]:
+        async def handle(message: Any) -> None:
+            root = getattr(message, "root", message)
+            if getattr(root, "method", None) == "notifications/tools/list_changed":
+                # Not a reconnect: drop the tools/catalog caches and flag the prompt as stale
+                self.invalidate_tools(server_id)
+                self.logger.write({"event":"tools/list_changed","server":server_id})
+                await self.notify_catalog_changed()
+        return handle
+
+    async def render_catalog(self) -> str:
+        """Catálogo JSON para el prompt del LLM, cacheado por conjunto de sesiones."""
+        key = frozenset(self._sessions.keys())
+        if self._catalog_cache is not None and key == self._catalog_key:
+            self.catalog_complete = True
+            return self._catalog_cache
+        tools = await self.list_tools()
+        display = {}
+        for sid, arr in tools.items():
+            display[sid] = [
+                {
+                    "name": t.get("name"),
+                    "description": t.get("description"),
+                    # Full schemas stay available through get_schema (:schema)
+                    "input_schema": _compact_schema(t.get("input_schema")),
+                } for t in arr
+            ]
+        rendered = dumps(display, indent=True)
+        self.catalog_empty = not any(display.values())
+        # Only cache a complete, non-empty listing; a failed server should be retried next time
+        self.catalog_complete = bool(tools) and set(tools.keys()) == key
+        if self.catalog_complete:
+            self._catalog_cache, self._catalog_key = rendered, key
+        return rendered
+
     async def get_schema(self, server_id: str, tool_name: str) -> Dict[str, Any]:
-        tools = await self.list_tools(server_id)
-        for t in tools.get(server_id, []):
-            if t.get("name") == tool_name:
-                return {"name": tool_name, "input_schema": t.get("input_schema"), "description": t.get("description")}
+        await self.list_tools(server_id)  # cache hit unless stale or invalidated
+        t = self._schema_index.get((server_id, tool_name))
+        if t is not None:
+            self._validator(server_id, tool_name)
+            return {"name": tool_name, "input_schema": t.get("input_schema"), "description": t.get("description")}
         raise RuntimeError(f"Herramienta no encontrada: {server_id}:{tool_name}")
 
+    def _validator(self, server_id: str, tool_name: str) -> Optional[Callable[[Any], Any]]:
+        # Compile each input_schema once; None means "can't validate locally"
+        key = (server_id, tool_name)
+        if key in self._validators:
+            return self._validators[key]
+        t = self._schema_index.get(key)
+        fn = None
+        if fastjsonschema is not None and t is not None and isinstance(t.get("input_schema"), dict):
+            try:
+                # use_default=False: the validator must never write schema defaults into args
+                fn = fastjsonschema.compile(t["input_schema"], use_default=False)
+            except Exception:
+                fn = None
+        self._validators[key] = fn
+        return fn
+
+    def validate_args(self, server_id: str, tool_name: str, args: Dict[str, Any]) -> None:
+        """Valida args contra el esquema cacheado; no hace RPC si la tool no está en caché."""
+        if (server_id, tool_name) not in self._schema_index:
+            return
+        fn = self._validator(server_id, tool_name)
+        if fn is None:
+            return
+        try:
+            fn(args)
+        except fastjsonschema.JsonSchemaException as e:
+            raise ValueError(f"Argumentos inválidos para {server_id}:{tool_name}: {e.message}") from e
+
+    async def _wait_session(self, server_id: str) -> Any:
+        session = self._sessions.get(server_id)
+        if session is not None:
+            return session
+        # Only wait while the server's task is alive (starting or reconnecting);
+        # a server that already failed answers "no conectado" immediately.
+        task = self._tasks.get(server_id)
+        ready = self._ready.get(server_id)
+        if server_id in self._dropped and (task is None or task.done()):
+            # Started fine earlier but its transport died: bring it back instead of failing
+            await self._reconnect(server_id, None)
+            return self._sessions.get(server_id)
+        if task is None or task.done() or ready is None:
+            return None
+        # Also wake up if the task ends first (failed start/reconnect): no point waiting it out
+        waiter = asyncio.ensure_future(ready.wait())
+        try:
+            await asyncio.wait({task, waiter}, timeout=self.READY_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        return self._sessions.get(server_id)
+
     async def call_tool(self, server_id: str, tool_name: str, args: Dict[str, Any]) -> Any:
         if True:
-            session = self._sessions.get(server_id)
+            session = await self._wait_session(server_id)
             if not session:
                 raise RuntimeError(f"Servidor no conectado: {server_id}")
             try:
-                self.logger.write({"event":"tools/call","server":server_id,"tool":tool_name,"args":args})
+                self.validate_args(server_id, tool_name, args or {})
+            except ValueError as e:
+                # Rejected locally: no RPC was sent, so there is no tools/call to log
+                self.logger.write({"event":"tools/invalid_args","server":server_id,"tool":tool_name,"args":_log_view(args),"error":str(e)})
+                raise
+            try:
+                self.logger.write({"event":"tools/call","server":server_id,"tool":tool_name,"args":_log_view(args)})
                 result = await session.call_tool(tool_name, args or {})
-                try:
-                    payload = getattr(result, "content", None)
-                    res = {"content": json.loads(json.dumps(payload, default=lambda o: getattr(o, "__dict__", str(o))))}
-                except Exception:
-                    res = json.loads(json.dumps(result, default=lambda o: getattr(o, "__dict__", str(o))))
-                self.logger.write({"event":"tools/response","server":server_id,"tool":tool_name,"result":res})
+                res = {"content": _to_plain(getattr(result, "content", None))}
+                self.logger.write({"event":"tools/response","server":server_id,"tool":tool_name,"result":_log_view(res)})
                 return res
             except Exception as e:
                 self.logger.write({"event":"tools/error","server":server_id,"tool":tool_name,"error":str(e)})
+                if _is_transport_error(e):
+                    # Not retried (tools may not be idempotent), but the next call finds a live session
+                    await self._reconnect(server_id, session)
                 raise
+
+    async def call_tool_batch(self, server_id: str, calls: List[Tuple[str, Dict[str, Any]]]) -> List[Any]:
+        """Ejecuta varias tools dependientes, en orden, sobre la misma sesión.
+
+        Falla antes de enviar nada si el servidor no está (ni llega a estar) listo y se detiene en
+        el primer error, para no gastar round-trips en pasos que ya no pueden funcionar.
+        """
+        if await self._wait_session(server_id) is None:
+            raise RuntimeError(f"Servidor no conectado: {server_id}")
+        results = []
+        for name, args in calls:
+            results.append(await self.call_tool(server_id, name, args))
+        return results
+
     async def run_inciso4_scenario(self) -> List[str]:
         steps: List[str] = []
+        # The fs server runs locally over stdio, so a local mkdir is enough (no extra RPC)
         WORKSPACE_DIR.mkdir(parents=True, exist_ok=True)
-        await self.call_tool("fs","mkdir",{"path": str(WORKSPACE_DIR), "exist_ok": True})
         steps.append(f"mkdir {WORKSPACE_DIR}")
         readme_path = WORKSPACE_DIR / "README.md"
         content = "# Proyecto MCP — Inciso 4\n\nEste README fue creado desde el host por una tool FS.\n"
@@ -117,9 +445,11 @@ class MCPClientManager:
         steps.append("write README.md")
         target_git = "github" if "github" in self._sessions else "git"
         try:
-            await self.call_tool(target_git,"git_init",{})
-            await self.call_tool(target_git,"git_add_all",{})
-            await self.call_tool(target_git,"git_commit",{"message":"chore: add README for inciso 4"})
+            await self.call_tool_batch(target_git, [
+                ("git_init", {}),
+                ("git_add_all", {}),
+                ("git_commit", {"message": "chore: add README for inciso 4"}),
+            ])
             steps.append(f"git init/add/commit via {target_git}")
         except Exception as e:
             steps.append(f"[ADVERTENCIA] Git no disponible ({e}) — omitiendo paso git")